@@ -1,16 +1,62 @@
+# Patch sockets before anything else imports them so Mongo calls yield to gevent.
+# Only when run directly: under gunicorn the gevent worker (gunicorn.conf.py)
+# patches before importing the app, and patching here would come too late.
+if __name__ == '__main__':
+    from gevent import monkey
+    monkey.patch_all()
+
 from flask import Flask, request, jsonify
+from flask.json.provider import DefaultJSONProvider
 from flask_cors import CORS
-from mongoengine import connect, Document, StringField, ListField, ReferenceField, DictField, DateField
-from datetime import datetime, timedelta
+from flask_caching import Cache
+from mongoengine import connect, NotUniqueError, Document, StringField, ListField, ReferenceField, DictField, DateField
+from bson import ObjectId
+from bson.errors import InvalidId
+from datetime import date, datetime, time, timedelta
 from dotenv import load_dotenv
+import gevent
+from gevent import monkey
+from passlib.hash import bcrypt
+from pymongo.errors import OperationFailure
+from redis.exceptions import RedisError
+import hmac
+import orjson
 import os
 
 # Load environment variables from .env file
 load_dotenv()
 
+class ORJSONProvider(DefaultJSONProvider):
+    # Serialize jsonify() responses with orjson, falling back to Flask's
+    # default() for types orjson doesn't know and keeping its sort_keys order
+    def dumps(self, obj, **kwargs):
+        option = orjson.OPT_SORT_KEYS if self.sort_keys else 0
+        return orjson.dumps(obj, default=self.default, option=option).decode()
+
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
+
 app = Flask(__name__)
+app.json = ORJSONProvider(app)
 CORS(app, resources={r"/*": {"origins": "*"}})
 
+# Cache GET responses in Redis; writes clear the whole prefix because every
+# expense view (and split_expense's roommate list) can change on any write
+cache = Cache(app, config={
+    'CACHE_TYPE': 'RedisCache',
+    'CACHE_REDIS_URL': os.getenv("REDIS_URL"),
+    'CACHE_KEY_PREFIX': 'wems_',
+    'CACHE_DEFAULT_TIMEOUT': 300
+})
+
+def clear_cached_views():
+    # Called after a write has been committed, so a Redis outage must not
+    # turn the response into a 500 (and invite a duplicate retry)
+    try:
+        cache.clear()
+    except RedisError as e:
+        app.logger.warning('Cache invalidation failed: %s', e)
+
 # Connect to MongoDB
 connect(
     host=os.getenv("MONGO_URI")
@@ -23,6 +69,15 @@ class Roommate(Document):
     password = StringField(required=True)
     phone = StringField(required=True)
 
+    # Created by ensure_roommate_index() so existing duplicate names can't
+    # break the first query that touches the collection
+    meta = {
+        'indexes': [
+            {'fields': ['name'], 'unique': True}
+        ],
+        'auto_create_index': False
+    }
+
     def to_dict(self):
         return {"id": str(self.id), "name": self.name, "email": self.email, "phone": self.phone}
 
@@ -33,43 +88,185 @@ class Expense(Document):
     purchased_by = ReferenceField(Roommate, required=True)
     consumed_by = ListField(ReferenceField(Roommate), required=True)
 
-    def to_dict(self):
-        return {
-            "id": str(self.id),
-            "date": self.date.strftime('%Y-%m-%d'),
-            "meal_type": self.meal_type,
-            "items": self.items,
-            "purchased_by": str(self.purchased_by.id) if self.purchased_by else None,
-            "consumed_by": [str(roommate.id) for roommate in self.consumed_by]
-        }
+    meta = {
+        'indexes': [
+            {'fields': ['date']},
+            {'fields': ['purchased_by']},
+            {'fields': ['consumed_by']}
+        ]
+    }
+
+roommate_index_ready = False
+
+def ensure_roommate_index():
+    # Built on first use rather than at import, so booting never waits on
+    # Mongo; existing duplicate names are logged instead of failing requests
+    global roommate_index_ready
+    if roommate_index_ready:
+        return
+    try:
+        Roommate.ensure_indexes()
+    except OperationFailure as e:
+        app.logger.warning('Unique index on roommate names not created (duplicate names?): %s', e)
+    roommate_index_ready = True
+
+# Passwords
+
+# bcrypt is deliberately slow CPU work; under gevent run it on the hub's
+# threadpool so a login doesn't stall every other request. Without patching
+# (flask run, sync gunicorn workers) each request has its own thread already,
+# and a per-thread hub would leak its pool threads, so call it directly.
+def run_cpu_bound(func, *args):
+    if monkey.is_module_patched('socket'):
+        return gevent.get_hub().threadpool.apply(func, args)
+    return func(*args)
+
+def hash_password(password):
+    return run_cpu_bound(bcrypt.hash, password)
+
+def check_password(roommate, password):
+    if bcrypt.identify(roommate.password):
+        return run_cpu_bound(bcrypt.verify, password, roommate.password)
+    # Accounts created before hashing still hold plaintext; upgrade on login
+    if not hmac.compare_digest(roommate.password.encode(), password.encode()):
+        return False
+    roommate.update(set__password=hash_password(password))
+    return True
+
+# Aggregation pipelines
+
+# Expense documents are small, so fetch more per getMore than the default 101
+CURSOR_BATCH_SIZE = 1000
+
+# Joins roommate names onto each expense server-side so listing expenses
+# costs one round trip instead of one lazy fetch per reference.
+EXPENSE_LOOKUP_PIPELINE = [
+    {"$lookup": {"from": "roommate", "localField": "purchased_by", "foreignField": "_id", "as": "pb"}},
+    {"$lookup": {"from": "roommate", "localField": "consumed_by", "foreignField": "_id", "as": "cb"}},
+    {"$addFields": {
+        "purchased_by_name": {"$arrayElemAt": ["$pb.name", 0]},
+        # $lookup does not preserve order, so map names back onto consumed_by;
+        # an id with no roommate gets null rather than $arrayElemAt's -1 (last) entry
+        "consumed_by_names": {"$map": {
+            "input": "$consumed_by",
+            "as": "rid",
+            "in": {"$let": {
+                "vars": {"idx": {"$indexOfArray": ["$cb._id", "$$rid"]}},
+                "in": {"$cond": [
+                    {"$eq": ["$$idx", -1]},
+                    None,
+                    {"$arrayElemAt": ["$cb.name", "$$idx"]}
+                ]}
+            }}
+        }},
+        "total_cost": {"$sum": "$items.cost"}
+    }},
+    {"$project": {"pb": 0, "cb": 0}}
+]
+
+# For handlers that resolve names from roommate_name_map() themselves
+EXPENSE_TOTAL_PIPELINE = [
+    {"$addFields": {"total_cost": {"$sum": "$items.cost"}}}
+]
+
+# Sums each roommate's share of every expense; prepend a date $match
+EXPENSE_SPLIT_PIPELINE = [
+    {"$project": {
+        "consumed_by": 1,
+        "share": {"$divide": [{"$sum": "$items.cost"}, {"$size": "$consumed_by"}]}
+    }},
+    {"$unwind": "$consumed_by"},
+    {"$group": {"_id": "$consumed_by", "amount": {"$sum": "$share"}}}
+]
+
+def date_match(start_date, end_date):
+    # DateField values are stored as midnight datetimes
+    return {"$match": {"date": {
+        "$gte": datetime.combine(start_date, time.min),
+        "$lte": datetime.combine(end_date, time.min)
+    }}}
+
+def aggregate_expenses(start_date=None, end_date=None, lookup_names=True, fields=None):
+    pipeline = EXPENSE_LOOKUP_PIPELINE if lookup_names else EXPENSE_TOTAL_PIPELINE
+    if fields is not None:
+        # Drop unread fields before any further stage touches them
+        pipeline = [{"$project": {field: 1 for field in fields}}] + pipeline
+    if start_date is not None and end_date is not None:
+        pipeline = [date_match(start_date, end_date)] + pipeline
+    return list(Expense._get_collection().aggregate(pipeline, batchSize=CURSOR_BATCH_SIZE))
+
+def aggregate_split(start_date, end_date):
+    pipeline = [date_match(start_date, end_date)] + EXPENSE_SPLIT_PIPELINE
+    return {str(row['_id']): row['amount'] for row in Expense._get_collection().aggregate(pipeline)}
+
+def roommate_name_map():
+    return {str(roommate.id): roommate.name for roommate in Roommate.objects.only('id', 'name')}
+
+# In-process id -> name cache (each worker keeps its own). A plain dict
+# rather than lru_cache because a miss should refill every name from one
+# roommate_name_map() query, not fetch a single id; that also picks up
+# roommates added through other workers. Names are never edited, and an id
+# still missing after the refill is remembered as None, since new roommates
+# always get fresh ObjectIds, so it never triggers another reload.
+roommate_names = {}
+
+def roommate_name(roommate_id):
+    if roommate_id not in roommate_names:
+        roommate_names.update(roommate_name_map())
+        roommate_names.setdefault(roommate_id, None)
+    return roommate_names[roommate_id]
+
+def has_operator_keys(value):
+    if isinstance(value, dict):
+        return any(key.startswith('$') or has_operator_keys(v) for key, v in value.items())
+    if isinstance(value, list):
+        return any(has_operator_keys(v) for v in value)
+    return False
+
+# Balances within this of zero are treated as settled
+SETTLE_EPSILON = 1e-9
 
 # Routes
 
-@app.route('/add_roommate', methods=['POST', 'OPTIONS'])
+# Answer CORS preflights before dispatch; Flask-CORS adds the headers in
+# its after_request hook. Unmatched URLs fall through to the usual 404/405.
+@app.before_request
+def cors_preflight():
+    if request.method == 'OPTIONS' and request.url_rule is not None:
+        return '', 204
+
+@app.route('/add_roommate', methods=['POST'])
 def add_roommate():
-    if request.method == 'OPTIONS':
-        return '', 200
-    
+    ensure_roommate_index()
     data = request.json
-    print(data)
-    roommate = Roommate(name=data['uname'], email=data['uemail'], password=data['upass'], phone=data['uphone'])
-    roommate.save()
+    app.logger.debug('add_roommate payload for: %s', data.get('uname'))
+    roommate = Roommate(name=data['uname'], email=data['uemail'], password=hash_password(data['upass']), phone=data['uphone'])
+    try:
+        roommate.save()
+    except NotUniqueError:
+        return jsonify({'message': 'A roommate with that name already exists'}), 409
+    clear_cached_views()
     return jsonify({'message': 'Roommate added successfully'}), 201
 
 
-@app.route('/login', methods=['POST', 'OPTIONS'])
+@app.route('/login', methods=['POST'])
 def login():
-    if request.method == 'OPTIONS':
-        return '', 200
-
+    ensure_roommate_index()
     data = request.json
-    print(data)
+    app.logger.debug('login payload for: %s', data.get('uname'))
     name = data.get('uname')
     password = data.get('upass')
 
     try:
-        # Find the roommate by name and password
-        roommate = Roommate.objects.get(name=name, password=password)
+        if not isinstance(name, str) or not isinstance(password, str) or not password:
+            raise Roommate.DoesNotExist
+        # Find the roommate by name, then check the password hash. Databases
+        # seeded before the unique index may still hold duplicate names, so
+        # accept whichever of them the password matches
+        candidates = Roommate.objects(name=name).only('name', 'password')
+        roommate = next((r for r in candidates if check_password(r, password)), None)
+        if roommate is None:
+            raise Roommate.DoesNotExist
         # Return a success message with the user's name and ID
         return jsonify({
             "message": "Login successful",
@@ -79,195 +276,224 @@ def login():
     except Roommate.DoesNotExist:
         return jsonify({"message": "Invalid name or password"}), 401
 
-@app.route('/addExpense', methods=['POST', 'OPTIONS'])
+@app.route('/addExpense', methods=['POST'])
 def add_expense():
-    if request.method == 'OPTIONS':
-        # Handle preflight request here
-        return '', 200
+    try:
+        data = request.json
+        
+        # Validate required fields
+        required_fields = ['date', 'mealType', 'items', 'purchasedBy', 'consumedBy']
+        missing_fields = [field for field in required_fields if field not in data or not data[field]]
+        
+        if missing_fields:
+            return jsonify({"message": f"Missing or empty required fields: {', '.join(missing_fields)}"}), 400
+        
+        # Additional checks for specific fields
+        if not isinstance(data['items'], list) or not all(isinstance(item, dict) for item in data['items']):
+            return jsonify({"message": "Items must be a list of dictionaries"}), 400
+        
+        # Check that each item in the items list contains both 'item' and 'cost' with valid values
+        for item in data['items']:
+            if not item.get('item') or not isinstance(item['item'], str):
+                return jsonify({"message": "Each item must contain a valid 'item' name"}), 400
+            if 'cost' not in item or not isinstance(item['cost'], (int, float)) or item['cost'] <= 0:
+                return jsonify({"message": "Each item must contain a valid 'cost' value"}), 400
+            # Items are inserted raw, so replace DictField's check for
+            # '$'-prefixed keys at any depth
+            if has_operator_keys(item):
+                return jsonify({"message": "Item keys must not start with '$'"}), 400
 
-    if request.method == 'POST':
-        try:
-            data = request.json
-            
-            # Validate required fields
-            required_fields = ['date', 'mealType', 'items', 'purchasedBy', 'consumedBy']
-            missing_fields = [field for field in required_fields if field not in data or not data[field]]
-            
-            if missing_fields:
-                return jsonify({"message": f"Missing or empty required fields: {', '.join(missing_fields)}"}), 400
-            
-            # Additional checks for specific fields
-            if not isinstance(data['items'], list) or not all(isinstance(item, dict) for item in data['items']):
-                return jsonify({"message": "Items must be a list of dictionaries"}), 400
-            
-            # Check that each item in the items list contains both 'item' and 'cost' with valid values
-            for item in data['items']:
-                if not item.get('item') or not isinstance(item['item'], str):
-                    return jsonify({"message": "Each item must contain a valid 'item' name"}), 400
-                if 'cost' not in item or not isinstance(item['cost'], (int, float)) or item['cost'] <= 0:
-                    return jsonify({"message": "Each item must contain a valid 'cost' value"}), 400
-
-            if not isinstance(data['consumedBy'], list) or not all(isinstance(id, str) for id in data['consumedBy']):
-                return jsonify({"message": "ConsumedBy must be a list of roommate IDs"}), 400
-            
-            # Create and save the expense
-            expense = Expense(
-                date=datetime.strptime(data['date'], '%Y-%m-%d').date(),
-                meal_type=data['mealType'],
-                items=data['items'],
-                purchased_by=Roommate.objects.get(id=data['purchasedBy']),
-                consumed_by=[Roommate.objects.get(id=id) for id in data['consumedBy']]
-            )
-            expense.save()
-
-            # Format the saved expense similarly to the get_expenses format
-            total_cost = sum(item.get('cost', 0) for item in expense.items)
-            expense_dict = expense.to_dict()
-
-            # Add the purchased_by name
-            purchased_by_name = expense.purchased_by.name if expense.purchased_by else None
-            expense_dict['purchased_by_name'] = purchased_by_name
-
-            # Add the consumed_by names
-            consumed_by_names = [roommate.name for roommate in expense.consumed_by]
-            expense_dict['consumed_by_names'] = consumed_by_names
-
-            # Add the total cost
-            expense_dict['total_cost'] = total_cost
-
-            return jsonify(expense_dict), 201
+        if not isinstance(data['consumedBy'], list) or not all(isinstance(id, str) for id in data['consumedBy']):
+            return jsonify({"message": "ConsumedBy must be a list of roommate IDs"}), 400
         
-        except Roommate.DoesNotExist:
-            return jsonify({"message": "Roommate not found"}), 404
-        except ValueError as ve:
-            return jsonify({"message": f"Invalid data format: {str(ve)}"}), 400
-        except Exception as e:
-            print(f"Error: {e}")
-            return jsonify({"message": "An error occurred while adding the expense"}), 500
+        if not isinstance(data['mealType'], str):
+            return jsonify({"message": "MealType must be a string"}), 400
+        
+        expense_date = date.fromisoformat(data['date'])
+        
+        # Resolve all referenced roommates in two queries instead of one per id
+        purchaser_id = ObjectId(data['purchasedBy'])
+        consumed_ids = [ObjectId(id) for id in data['consumedBy']]
+        purchased_by = Roommate.objects(id=purchaser_id).only('name').first()
+        consumer_names = {roommate.id: roommate.name for roommate in Roommate.objects(id__in=consumed_ids).only('name')}
+        if purchased_by is None or len(consumer_names) != len(set(consumed_ids)):
+            raise Roommate.DoesNotExist
+
+        # The fields are validated above, so insert the raw document and
+        # skip building an Expense just to run to_mongo() on it
+        result = Expense._get_collection().insert_one({
+            "date": datetime.combine(expense_date, time.min),
+            "meal_type": data['mealType'],
+            "items": data['items'],
+            "purchased_by": purchased_by.id,
+            "consumed_by": consumed_ids
+        })
+        clear_cached_views()
+
+        # Format the saved expense similarly to the get_expenses format
+        expense_dict = {
+            "id": str(result.inserted_id),
+            "date": expense_date.isoformat(),
+            "meal_type": data['mealType'],
+            "items": data['items'],
+            "purchased_by": str(purchased_by.id),
+            "consumed_by": [str(rid) for rid in consumed_ids],
+            "purchased_by_name": purchased_by.name,
+            "consumed_by_names": [consumer_names[rid] for rid in consumed_ids],
+            "total_cost": sum(item.get('cost', 0) for item in data['items'])
+        }
+
+        return jsonify(expense_dict), 201
+    
+    except Roommate.DoesNotExist:
+        return jsonify({"message": "Roommate not found"}), 404
+    except InvalidId as ie:
+        return jsonify({"message": f"Invalid roommate ID: {str(ie)}"}), 400
+    except ValueError as ve:
+        return jsonify({"message": f"Invalid data format: {str(ve)}"}), 400
+    except Exception:
+        app.logger.exception('Error adding expense')
+        return jsonify({"message": "An error occurred while adding the expense"}), 500
 
 
 @app.route('/roommates', methods=['GET'])
+@cache.cached(timeout=600)
 def get_roommates():
     roommates = Roommate.objects()
     return jsonify([roommate.to_dict() for roommate in roommates]), 200
 
 @app.route('/expenses', methods=['GET'])
+@cache.cached(timeout=60)
 def get_expenses():
-    expenses = Expense.objects()
     response = []
 
-    for expense in expenses:
-        total_cost = sum(item.get('cost', 0) for item in expense.items)
-        expense_dict = expense.to_dict()
-        
-        # Add the purchased_by name
-        purchased_by_name = expense.purchased_by.name if expense.purchased_by else None
-        expense_dict['purchased_by_name'] = purchased_by_name
-        
-        # Add the consumed_by names
-        consumed_by_names = [roommate.name for roommate in expense.consumed_by]
-        expense_dict['consumed_by_names'] = consumed_by_names
-        
-        # Add the total cost
-        expense_dict['total_cost'] = total_cost
-        
-        response.append(expense_dict)
+    for expense in aggregate_expenses():
+        response.append({
+            "id": str(expense['_id']),
+            "date": expense['date'].date().isoformat(),
+            "meal_type": expense['meal_type'],
+            "items": expense['items'],
+            "purchased_by": str(expense['purchased_by']) if expense.get('purchased_by') else None,
+            "consumed_by": [str(rid) for rid in expense['consumed_by']],
+            "purchased_by_name": expense.get('purchased_by_name'),
+            "consumed_by_names": expense['consumed_by_names'],
+            "total_cost": expense['total_cost']
+        })
 
     return jsonify(response), 200
 
 @app.route('/split_expense', methods=['GET'])
+@cache.cached(timeout=3600, query_string=True)
 def split_expense():
-    start_date = datetime.strptime(request.args.get('start_date'), '%Y-%m-%d').date()
+    start_date = date.fromisoformat(request.args.get('start_date'))
     start_of_week = start_date - timedelta(days=start_date.weekday())
     end_of_week = start_of_week + timedelta(days=6)
     
-    expenses = Expense.objects(date__gte=start_of_week, date__lte=end_of_week)
-    roommate_expenses = {str(roommate.id): {'name': roommate.name, 'amount': 0} for roommate in Roommate.objects()}
-    
-    for expense in expenses:
-        total_cost = sum(item['cost'] for item in expense.items)
-        split_amount = total_cost / len(expense.consumed_by)
-        
-        for roommate in expense.consumed_by:
-            roommate_expenses[str(roommate.id)]['amount'] += split_amount
+    amounts = aggregate_split(start_of_week, end_of_week)
+    # Every roommate is listed, including those with nothing to pay
+    roommate_expenses = {roommate_id: {'name': name, 'amount': amounts.get(roommate_id, 0)}
+                         for roommate_id, name in roommate_name_map().items()}
     
     return jsonify(roommate_expenses), 200
 
 @app.route('/weekly_report', methods=['GET'])
+@cache.cached(timeout=3600, query_string=True)
 def weekly_report():
-    start_date = datetime.strptime(request.args.get('start_date'), '%Y-%m-%d').date()
+    start_date = date.fromisoformat(request.args.get('start_date'))
     start_date = start_date - timedelta(days=start_date.weekday())
     end_date = start_date + timedelta(days=6)
     
-    expenses = Expense.objects(date__gte=start_date, date__lte=end_date)
+    expenses = aggregate_expenses(start_date, end_date, lookup_names=False,
+                                  fields=['items', 'purchased_by', 'consumed_by'])
     
     report = {}
     spending = {}
     consumption = {}
     
+    def new_report_entry(roommate_id):
+        return {
+            'name': roommate_name(roommate_id),
+            'total_amount': 0,
+            'total_items': 0,
+            'items': {},
+            'owed_by': [],
+            'owes_to': []
+        }
+    
     for expense in expenses:
-        purchaser_id = str(expense.purchased_by.id)
+        purchaser_id = str(expense['purchased_by'])
+        exp_total = expense['total_cost']
+        per_head = exp_total / len(expense['consumed_by'])
         if purchaser_id not in spending:
             spending[purchaser_id] = 0
-        spending[purchaser_id] += sum(item['cost'] for item in expense.items)
+        spending[purchaser_id] += exp_total
+        
+        # Every consumer gets the same item costs, so group them once per expense
+        items_by_name = {}
+        for item in expense['items']:
+            items_by_name[item['item']] = items_by_name.get(item['item'], 0) + item['cost']
         
-        for roommate in expense.consumed_by:
-            roommate_id = str(roommate.id)
+        for consumer_id in expense['consumed_by']:
+            roommate_id = str(consumer_id)
             if roommate_id not in report:
-                report[roommate_id] = {
-                    'name': roommate.name,
-                    'total_amount': 0,
-                    'total_items': 0,
-                    'items': {},
-                    'owed_by': [],
-                    'owes_to': []
-                }
+                report[roommate_id] = new_report_entry(roommate_id)
             
             if roommate_id not in consumption:
                 consumption[roommate_id] = 0
-            consumption[roommate_id] += sum(item['cost'] for item in expense.items) / len(expense.consumed_by)
+            consumption[roommate_id] += per_head
             
-            for item in expense.items:
-                if item['item'] not in report[roommate_id]['items']:
-                    report[roommate_id]['items'][item['item']] = 0
+            bucket = report[roommate_id]['items']
+            for name, cost in items_by_name.items():
+                if name not in bucket:
+                    bucket[name] = 0
                     report[roommate_id]['total_items'] += 1
-                report[roommate_id]['items'][item['item']] += item['cost']
+                bucket[name] += cost
             
-            report[roommate_id]['total_amount'] += sum(item['cost'] for item in expense.items)
+            report[roommate_id]['total_amount'] += exp_total
     
+    # Anyone who only consumed still owes, and anyone who only purchased is
+    # still owed, so balance over both sides and give purchasers an entry too
     balances = {}
-    for roommate_id, total_spent in spending.items():
-        total_consumed = consumption.get(roommate_id, 0)
-        balance = total_spent - total_consumed
-        balances[roommate_id] = balance
+    participants = list(spending) + [rid for rid in consumption if rid not in spending]
+    for roommate_id in participants:
+        balances[roommate_id] = spending.get(roommate_id, 0) - consumption.get(roommate_id, 0)
+        if roommate_id not in report:
+            report[roommate_id] = new_report_entry(roommate_id)
         
-    for roommate_id, balance in balances.items():
-        if balance > 0:
-            for other_id, other_balance in balances.items():
-                if other_id != roommate_id and other_balance < 0:
-                    amount = min(balance, -other_balance)
-                    report[roommate_id]['owed_by'].append({
-                        'user': report[other_id]['name'],
-                        'amount': amount
-                    })
-                    report[other_id]['owes_to'].append({
-                        'user': report[roommate_id]['name'],
-                        'amount': amount
-                    })
-                    balances[roommate_id] -= amount
-                    balances[other_id] += amount
-                    if balances[roommate_id] == 0:
-                        break
+    # Settle debts in one sweep: largest creditor against largest debtor,
+    # advancing whichever side is paid off
+    creditors = sorted([[rid, b] for rid, b in balances.items() if b > SETTLE_EPSILON], key=lambda x: -x[1])
+    debtors = sorted([[rid, -b] for rid, b in balances.items() if b < -SETTLE_EPSILON], key=lambda x: -x[1])
+    i = j = 0
+    while i < len(creditors) and j < len(debtors):
+        creditor_id, credit = creditors[i]
+        debtor_id, debt = debtors[j]
+        amount = min(credit, debt)
+        report[creditor_id]['owed_by'].append({
+            'user': roommate_name(debtor_id),
+            'amount': amount
+        })
+        report[debtor_id]['owes_to'].append({
+            'user': roommate_name(creditor_id),
+            'amount': amount
+        })
+        creditors[i][1] -= amount
+        debtors[j][1] -= amount
+        if creditors[i][1] < SETTLE_EPSILON:
+            i += 1
+        if debtors[j][1] < SETTLE_EPSILON:
+            j += 1
     
     report_list = []
     for roommate_id, data in report.items():
         report_list.append(data)
     
     return jsonify({
-        'week_start_date': start_date.strftime('%Y-%m-%d'),
-        'week_end_date': end_date.strftime('%Y-%m-%d'),
+        'week_start_date': start_date.isoformat(),
+        'week_end_date': end_date.isoformat(),
         'report': report_list
     }), 200
 
 if __name__ == '__main__':
-    app.run(debug=True, port=5001)
+    from gevent.pywsgi import WSGIServer
+    WSGIServer(('0.0.0.0', 5001), app).serve_forever()
@@ -0,0 +1,3 @@
+# app.py relies on gevent for concurrency; the gevent worker monkey-patches
+# the stdlib before the app module is imported
+worker_class = 'gevent'